@@ -1,13 +1,20 @@
 import streamlit as st
-import osmnx as ox
 import pandas as pd
+import numpy as np
 import re
-import requests
+import io
+import httpx
+import os
 import time
+import threading
+import math
+import functools
 import concurrent.futures
+import diskcache
+import h3
+from collections import Counter
 from urllib.parse import urlparse, parse_qs
-from geopy.geocoders import Nominatim
-from geopy.distance import geodesic
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
 
 # -------------------------------------------
 # 0. 駅ランク定義 (P0〜P7)
@@ -24,6 +31,26 @@ STATION_RANKS = {
     'P7': ['日の出', '面影橋', '有明', '飛鳥山', '都電雑司ヶ谷', '滝野川一丁目', '浮間舟渡', '志村三丁目', '新高島平', '栄町', '小田急永山', '江戸川', '多摩動物公園', '神奈川', '羽田空港国際線ビル', '豊田', '東村山', 'お花茶屋', '久米川', '武蔵関', '京王堀之内', '南大沢', '北府中', '矢川', '矢野口', '競艇場前', '南平', '箱根ヶ崎', '百草園', '高幡不動', '平山城址公園', '長沼', '京王片倉']
 }
 
+# -------------------------------------------
+# 0.5 道路種別定義
+# -------------------------------------------
+# 道路種別 -> (スコア, 判定理由)
+HIGHWAY_CATEGORY = {
+    # 5点: 幹線道路
+    'motorway': (5, "幹線道路({})"), 'trunk': (5, "幹線道路({})"),
+    'primary': (5, "幹線道路({})"), 'secondary': (5, "幹線道路({})"),
+    # 4点: バス通り
+    'tertiary': (4, "バス通り({})"),
+    # 3点: 商店街扱い
+    'pedestrian': (3, "商店街/歩行者優先({})"), 'living_street': (3, "商店街/歩行者優先({})"),
+    # 1点: 住宅街
+    'residential': (1, "住宅街({})"), 'unclassified': (1, "住宅街({})"),
+    # 0点: 敷地内通路・私道
+    'service': (0, "敷地内/私道"),
+}
+DEFAULT_HIGHWAY_CATEGORY = (0, "その他({})")
+NON_VEHICLE_HIGHWAYS = frozenset({'footway', 'path', 'steps', 'cycleway'})
+
 # -------------------------------------------
 # 1. ページ設定
 # -------------------------------------------
@@ -33,45 +60,117 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
+# -------------------------------------------
+# 1.5 重いライブラリの遅延読み込み
+# -------------------------------------------
+# osmnx (GeoPandas/Shapely/NetworkX等を含む) の読み込みは重いので、最初の判定時まで遅らせる
+@st.cache_resource(show_spinner=False)
+def load_osmnx():
+    import osmnx as ox
+    ox.settings.log_console = False
+    # 都市グラフの事前取得で使うOverpass応答もディスクに残し、再起動後の再取得を省く
+    ox.settings.use_cache = True
+    ox.settings.cache_folder = os.path.join(os.path.expanduser('~'), '.cache', 'portvis', 'osmnx')
+    ox.settings.requests_timeout = 30
+    ox.settings.overpass_rate_limit = True
+    ox.settings.overpass_url = OVERPASS_URL.rsplit('/', 1)[0]
+    return ox
+
 # -------------------------------------------
 # 2. 座標抽出ロジック
 # -------------------------------------------
+# 短縮URL展開・Overpass問い合わせ用のHTTPクライアント
+# HTTP/2 + keep-aliveで、並列の問い合わせも1本の接続に多重化して使い回す (スレッドセーフ)
+# 再実行のたびに作り直さないよう、プロセス内で1つだけ作る
+@st.cache_resource(show_spinner=False)
+def get_http_client():
+    return httpx.Client(
+        transport=httpx.HTTPTransport(http2=True, retries=1, limits=httpx.Limits(max_keepalive_connections=20)),
+        timeout=10
+    )
+
+# GoogleマップURL中の座標パターン
+_RE_AT = re.compile(r'@(-?\d+\.\d+),(-?\d+\.\d+)')
+_RE_3D = re.compile(r'!3d(-?\d+\.\d+)')
+_RE_4D = re.compile(r'!4d(-?\d+\.\d+)')
+# 数字と区切り記号だけの入力 (座標として読めなかったものは住所検索しても無駄)
+_RE_NUMERIC_ONLY = re.compile(r'[\d.,\s\-]+')
+# 住所表記に使われる行政区画の文字 (含まれていれば座標ではなく住所とみなす)
+_RE_JP_ADMIN = re.compile(r'[都道府県市区町村]')
+# 「緯度,経度」だけのセル (CSV列をまとめて解析する用)
+_RE_COORD_PAIR = re.compile(r'^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$')
+
+# 住所ジオコーダ (プロセス内で1つだけ作る)
+# 並列実行時もNominatimの利用規約 (1秒1リクエスト) を守るため、住所検索だけ間隔を空ける
+@st.cache_resource(show_spinner=False)
+def get_geocoder():
+    from geopy.geocoders import Nominatim
+    from geopy.extra.rate_limiter import RateLimiter
+    # 失敗をNoneにせず例外で返す (Noneだと「見つからない」としてキャッシュされてしまうため)
+    return RateLimiter(Nominatim(user_agent="scooter_port_scorer_app", timeout=10).geocode,
+                       min_delay_seconds=1.0, max_retries=1, swallow_exceptions=False)
+
+# 住所→(緯度, 経度) の結果は再実行・セッションをまたいで使い回す (例外はキャッシュされない)
+@st.cache_data(show_spinner=False)
+def _geocode_cached(address):
+    location = get_geocoder()(address)
+    return (location.latitude, location.longitude) if location else None
+
+def to_coords(lat, lon):
+    """
+    緯度・経度として有効なら (lat, lon) を返す。nan・infや範囲外の値はNone
+    """
+    lat, lon = float(lat), float(lon)
+    if -90 <= lat <= 90 and -180 <= lon <= 180:
+        return lat, lon
+    return None
+
+# 同じURL・住所が何行も並ぶCSVでは、展開や検索を1回で済ませる
+@functools.lru_cache(maxsize=4096)
 def extract_coords_from_input(user_input):
     if not isinstance(user_input, str): return None
     user_input = user_input.strip()
+    is_url = user_input[:8].lower().startswith(('http://', 'https:/'))
+    has_comma = ',' in user_input
 
     # パターンA: 直接座標入力
     try:
-        if ',' in user_input and 'http' not in user_input and not any(c in user_input for c in "都道府県市区町村"):
+        if has_comma and not is_url and not _RE_JP_ADMIN.search(user_input):
             parts = user_input.split(',')
-            return float(parts[0]), float(parts[1])
-    except: pass
+            return to_coords(parts[0], parts[1])
+    except (ValueError, IndexError): pass
 
     # パターンB: URL入力
-    if 'http' in user_input:
+    if is_url:
         try:
-            response = requests.get(user_input, allow_redirects=True, timeout=5)
-            final_url = response.url
-            match = re.search(r'@(-?\d+\.\d+),(-?\d+\.\d+)', final_url)
-            if match: return float(match.group(1)), float(match.group(2))
+            # リダイレクト先URLだけ分かれば良いので本文は取得しない (HEAD非対応ならGET)
+            response = get_http_client().head(user_input, follow_redirects=True, timeout=5)
+            if response.is_error:
+                response = get_http_client().get(user_input, follow_redirects=True, timeout=5)
+            final_url = str(response.url)
+            match = _RE_AT.search(final_url)
+            if match: return to_coords(match.group(1), match.group(2))
             parsed = urlparse(final_url)
             qs = parse_qs(parsed.query)
             if 'q' in qs:
                 coords = qs['q'][0].split(',')
-                if len(coords) >= 2: return float(coords[0]), float(coords[1])
-            lat_match = re.search(r'!3d(-?\d+\.\d+)', final_url)
-            lon_match = re.search(r'!4d(-?\d+\.\d+)', final_url)
+                if len(coords) >= 2: return to_coords(coords[0], coords[1])
+            lat_match = _RE_3D.search(final_url)
+            lon_match = _RE_4D.search(final_url)
             if lat_match and lon_match:
-                return float(lat_match.group(1)), float(lon_match.group(1))
-        except: return None
+                return to_coords(lat_match.group(1), lon_match.group(1))
+        except (httpx.HTTPError, httpx.InvalidURL, ValueError, IndexError): return None
+        # URLから座標が取れなかった場合は住所検索に回さない
+        return None
 
     # パターンC: 日本語住所入力
+    # 共有テキスト等でURLが途中に含まれている場合も住所検索には回さない
+    if 'http' in user_input: return None
+    if _RE_NUMERIC_ONLY.fullmatch(user_input): return None
+    from geopy.exc import GeopyError
     try:
-        geolocator = Nominatim(user_agent="scooter_port_scorer_app")
-        location = geolocator.geocode(user_input)
-        if location: return location.latitude, location.longitude
-    except: return None
-    return None
+        return _geocode_cached(user_input.lower())
+    except GeopyError: return None
 
 # -------------------------------------------
 # 3. 駅ランク特定ヘルパー
@@ -86,90 +185,406 @@ def get_station_rank_from_name(station_name):
                 return rank
     return 'P_OTHER'
 
+# -------------------------------------------
+# 3.4 周辺データ取得 (Overpass直接問い合わせ)
+# -------------------------------------------
+OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+OVERPASS_MAX_RPS = 2            # Overpassへの送信レート上限 (スレッド数に関係なくプロセス全体で)
+OVERPASS_MAX_CONCURRENT = 2     # 同時に投げる問い合わせ数の上限 (overpass-api.deはIPごとの同時スロット数で制限する)
+
+STATION_SEARCH_DIST = 800       # 駅: 徒歩10分圏内
+ROAD_SEARCH_DIST = 100          # 道路種別
+INTERSECTION_SEARCH_DIST = 50   # 交差点・歩道横の車道
+
+# 混雑・ゲートウェイ系の一時的なステータス
+TRANSIENT_STATUS_CODES = (429, 502, 503, 504)
+
+def is_transient_error(e):
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in TRANSIENT_STATUS_CODES
+    return isinstance(e, httpx.TransportError)
+
+# タイムアウト・接続エラーやOverpassの混雑応答など、一時的な通信エラーのときだけ1回再試行する
+retry_on_network_error = retry(
+    stop=stop_after_attempt(2),
+    wait=wait_exponential(multiplier=0.5, max=2),
+    retry=retry_if_exception(is_transient_error),
+    reraise=True
+)
+
+def station_query(lat, lon, dist):
+    return f"""(
+      nwr(around:{dist},{lat},{lon})["railway"~"^(station|subway_entrance)$"];
+      nwr(around:{dist},{lat},{lon})["public_transport"="station"];
+    )"""
+
+def road_query(lat, lon, dist):
+    # network_type='all' 相当 (工事中・計画中の道路や広場は除く)
+    return (f'way(around:{dist},{lat},{lon})["highway"]["area"!~"yes"]'
+            '["highway"!~"^(abandoned|construction|no|planned|platform|proposed|raceway|razed)$"]'
+            '["service"!~"private"]')
+
+# スレッド数ではなく、同時実行数と送信間隔でサーバー負荷を抑える
+# (同時実行はセマフォで制限し、送信開始は各リクエストに1/RPS秒ずつ枠を割り当てて間隔を空ける)
+# 全セッション・再実行で同じ状態を共有するよう、cache_resourceでプロセス内に1つだけ作る
+@st.cache_resource(show_spinner=False)
+def get_overpass_limiter():
+    slots = threading.BoundedSemaphore(OVERPASS_MAX_CONCURRENT)
+    lock = threading.Lock()
+    next_slot = 0.0
+
+    def wait_for_slot():
+        nonlocal next_slot
+        with lock:
+            now = time.monotonic()
+            slot = max(now, next_slot)
+            next_slot = slot + 1 / OVERPASS_MAX_RPS
+        if slot > now: time.sleep(slot - now)
+    return slots, wait_for_slot
+
+def post_overpass(query):
+    slots, wait_for_slot = get_overpass_limiter()
+    with slots:
+        wait_for_slot()
+        response = get_http_client().post(OVERPASS_URL, data={'data': query}, timeout=30)
+    response.raise_for_status()
+    data = response.json()
+    # タイムアウト・メモリ超過でも200で返り、remarkに理由、elementsは途中までになるので失敗として扱う
+    if 'remark' in data:
+        raise ValueError(f"Overpass: {data['remark']}")
+    return data['elements']
+
+def parse_stations(elements):
+    """
+    Overpassの結果から駅を (駅名, 緯度, 経度) のリストで取り出す
+    """
+    stations = []
+    for el in elements:
+        # 道路(geometry付き)は除く。nodeはlat/lon、way/relationはcenterに代表点が入る
+        if 'geometry' in el: continue
+        point = el.get('center', el)
+        if 'lat' not in point: continue
+        stations.append((el.get('tags', {}).get('name'), point['lat'], point['lon']))
+    return stations
+
+def parse_roads(elements):
+    """
+    Overpassの結果から道路を (道路種別, ノードID列, 座標列) のリストで取り出す
+    """
+    roads = []
+    for el in elements:
+        if 'geometry' not in el: continue
+        coords = [(p['lat'], p['lon']) for p in el['geometry']]
+        roads.append((el['tags'].get('highway'), el['nodes'], coords))
+    return roads
+
+@retry_on_network_error
+def fetch_nearby_stations(lat, lon, dist):
+    """
+    半径dist(m)以内の駅・地下鉄出入口を (駅名, 緯度, 経度) のリストで返す
+    GeoDataFrameは作らず、JSONから名前と代表点だけを取り出す
+    """
+    query = f"""
+    [out:json][timeout:15];
+    {station_query(lat, lon, dist)};
+    out tags center qt;
+    """
+    return parse_stations(post_overpass(query))
+
+@retry_on_network_error
+def fetch_stations_and_roads(lat, lon):
+    """
+    駅(半径800m)と道路(半径100m)を1回の問い合わせでまとめて取得する
+    """
+    query = f"""
+    [out:json][timeout:25];
+    {station_query(lat, lon, STATION_SEARCH_DIST)}->.stations;
+    {road_query(lat, lon, ROAD_SEARCH_DIST)}->.roads;
+    .stations out tags center qt;
+    .roads out body geom qt;
+    """
+    elements = post_overpass(query)
+    return parse_stations(elements), parse_roads(elements)
+
+def get_neighborhood(lat, lon):
+    """
+    (駅リスト, 道路リスト) を返す。事前取得済みの都市内なら道路は都市グラフから切り出し、駅だけを問い合わせる
+    """
+    roads = get_city_roads(lat, lon, ROAD_SEARCH_DIST)
+    if roads is not None:
+        return fetch_nearby_stations(lat, lon, STATION_SEARCH_DIST), roads
+    return fetch_stations_and_roads(lat, lon)
+
+# -------------------------------------------
+# 3.5 道路データ解析ヘルパー
+# -------------------------------------------
+# network_type='drive' 相当の道路種別
+DRIVABLE_HIGHWAYS = frozenset({
+    'motorway', 'motorway_link', 'trunk', 'trunk_link', 'primary', 'primary_link',
+    'secondary', 'secondary_link', 'tertiary', 'tertiary_link',
+    'unclassified', 'residential', 'living_street', 'service', 'road'
+})
+EARTH_RADIUS = 6371009
+
+def to_local_xy(lat, lon, lat0, lon0):
+    """
+    (lat0, lon0) を原点とする平面座標(m)に変換する（数km以内なら誤差は無視できる。numpy配列も可）
+    """
+    k = math.pi / 180 * EARTH_RADIUS
+    return (lon - lon0) * k * math.cos(math.radians(lat0)), (lat - lat0) * k
+
+def split_into_segments(roads, lat, lon):
+    """
+    道路リストを区間(隣り合うノード間の線分)ごとに分け、(道路種別, 始点ID, 終点ID, 始点xy, 終点xy, 原点からの距離) にする
+    道路種別・ノードIDはリスト、座標・距離は区間数ぶんのnumpy配列（座標は(lat, lon)が原点）
+    """
+    highways, u_ids, v_ids, starts, ends = [], [], [], [], []
+    for highway, node_ids, coords in roads:
+        if isinstance(highway, list): highway = highway[0]
+        highways += [highway] * (len(node_ids) - 1)
+        u_ids += node_ids[:-1]
+        v_ids += node_ids[1:]
+        starts += coords[:-1]
+        ends += coords[1:]
+
+    starts = np.array(starts, dtype=float).reshape(-1, 2)
+    ends = np.array(ends, dtype=float).reshape(-1, 2)
+    A = np.column_stack(to_local_xy(starts[:, 0], starts[:, 1], lat, lon))
+    B = np.column_stack(to_local_xy(ends[:, 0], ends[:, 1], lat, lon))
+    return highways, u_ids, v_ids, A, B, distance_to_segments(A, B)
+
+def distance_to_segments(A, B):
+    """
+    原点から各線分AB(始点A・終点Bの(N, 2)配列)までの距離(m)をまとめて計算する
+    """
+    AB = B - A
+    length2 = (AB * AB).sum(axis=1)
+    t = np.clip(-(A * AB).sum(axis=1) / np.where(length2 == 0, 1, length2), 0, 1)
+    closest = A + t[:, None] * AB
+    return np.hypot(closest[:, 0], closest[:, 1])
+
+def nearest_highway(segments, max_dist, highways=None):
+    """
+    原点からmax_dist(m)以内で最も近い区間の道路種別を返す（highways指定時はその種別のみ。なければNone）
+    """
+    seg_highways, _, _, _, _, dists = segments
+    mask = dists <= max_dist
+    if highways is not None:
+        mask &= np.fromiter((h in highways for h in seg_highways), dtype=bool, count=len(seg_highways))
+    if not mask.any():
+        return None
+    return seg_highways[np.flatnonzero(mask)[dists[mask].argmin()]]
+
+def has_intersection(segments, max_dist):
+    """
+    車道のノードのうち、原点からmax_dist(m)以内で最も近い「道の途中ではない」ノードが交差点かどうか
+    （接続する区間数で判定: 2は道の途中、1は行き止まり、3以上は交差点）
+    """
+    seg_highways, u_ids, v_ids, A, B, _ = segments
+    # 接続数を数える必要があるのは、どちらかの端点がmax_dist以内にある区間だけ
+    near = (np.hypot(A[:, 0], A[:, 1]) <= max_dist) | (np.hypot(B[:, 0], B[:, 1]) <= max_dist)
+    street_count = Counter()
+    node_xy = {}
+    seen = set()
+    for i in np.flatnonzero(near):
+        highway, u, v, a, b = seg_highways[i], u_ids[i], v_ids[i], A[i], B[i]
+        if highway not in DRIVABLE_HIGHWAYS: continue
+        # 往復の区間や同じ区間を重複して数えない
+        edge = frozenset((u, v))
+        if edge in seen: continue
+        seen.add(edge)
+        street_count[u] += 1
+        street_count[v] += 1
+        node_xy[u], node_xy[v] = a, b
+
+    candidates = []
+    for n, count in street_count.items():
+        d = math.hypot(*node_xy[n])
+        if count != 2 and d <= max_dist:
+            candidates.append((d, count))
+    return bool(candidates) and min(candidates)[1] >= 3
+
+# -------------------------------------------
+# 3.6 分析結果キャッシュ (st.cache_data → ディスク → Overpass)
+# -------------------------------------------
+# 座標はH3セル(解像度11、一辺約25m)に変換してキーにし、同じセル内の地点は同じ結果を使う
+# ディスク側は再起動・再デプロイ後も残るが、OSMの更新を拾うため一定期間で期限切れにする
+H3_RESOLUTION = 11
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'portvis', 'v2')
+CACHE_EXPIRE = 30 * 24 * 3600    # 30日
+# 採点ロジック (HIGHWAY_CATEGORY・ランクの閾値など) を変えたら上げる。古い結果はキーが変わって使われなくなる
+SCORING_VERSION = 1
+# 同じ座標の再判定用 (プロセス内に持つ件数の上限)
+RESULT_MEMORY_ENTRIES = 4096
+
+# Streamlitはスクリプトを毎回実行し直すので、ディスクキャッシュはcache_resourceで1つだけ開く
+@st.cache_resource(show_spinner=False)
+def get_result_cache():
+    return diskcache.Cache(CACHE_DIR)
+
+class NeighborhoodFetchError(Exception):
+    """
+    周辺データの取得に失敗したときの例外。暫定の判定結果をresultに持つ
+    (例外として返すことで、どのキャッシュ層にも失敗結果が残らない)
+    """
+    def __init__(self, result, cause):
+        super().__init__(str(cause))
+        self.result = result
+
+def quantized_cache(func):
+    @functools.wraps(func)
+    def wrapper(lat, lon):
+        disk_cache = get_result_cache()
+        key = (SCORING_VERSION, h3.latlng_to_cell(lat, lon, H3_RESOLUTION))
+        result = disk_cache.get(key)
+        if result is None:
+            # 取得失敗時はNeighborhoodFetchErrorがそのまま抜けるので保存されず、次回また取得し直す
+            result = func(lat, lon)
+            disk_cache.set(key, result, expire=CACHE_EXPIRE)
+        return result
+    return wrapper
+
+# -------------------------------------------
+# 3.7 主要都市の道路グラフ (事前取得)
+# -------------------------------------------
+# 利用の多い都市は広域グラフを一度だけ取得してgraphmlで保存しておき、
+# 範囲内の判定ではOverpassに道路を問い合わせずメモリ上で切り出す
+# (都市名, 中心緯度, 中心経度)
+CITIES = [
+    ('tokyo', 35.6812, 139.7671),
+    ('yokohama', 35.4660, 139.6223),
+    ('chiba', 35.6131, 140.1135),
+]
+CITY_GRAPH_DIST = 5000
+GRAPH_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'portvis', 'graphs')
+# 未取得の都市グラフをダウンロードするのは PORTVIS_PREWARM=1 のときだけ (数分・数百MBかかるため)
+PREWARM_CITY_GRAPHS = os.environ.get('PORTVIS_PREWARM') == '1'
+
+@st.cache_resource(show_spinner=False)
+def load_city_graphs():
+    """
+    保存済みの都市グラフを読み込み、(判定可能範囲のbbox, 都市中心, グラフ, ノードのKDTree, ノードID一覧) のリストで返す
+    """
+    paths = {name: os.path.join(GRAPH_DIR, f"{name}.graphml") for name, _, _ in CITIES}
+    # 保存済みグラフも事前取得の指定もなければ、osmnx等の重いライブラリは読み込まない
+    if not PREWARM_CITY_GRAPHS and not any(os.path.exists(path) for path in paths.values()):
+        return []
+    from scipy.spatial import cKDTree
+    ox = load_osmnx()
+    cities = []
+    for name, c_lat, c_lon in CITIES:
+        path = paths[name]
+        if os.path.exists(path):
+            G = ox.load_graphml(path)
+        elif PREWARM_CITY_GRAPHS:
+            G = ox.graph_from_point((c_lat, c_lon), dist=CITY_GRAPH_DIST, network_type='all', simplify=False)
+            ox.save_graphml(G, path)
+        else:
+            continue
+        # KDTreeは都市中心を原点とする平面座標(m)で作る
+        node_ids = list(G.nodes)
+        xs, ys = to_local_xy(np.array([G.nodes[n]['y'] for n in node_ids]),
+                             np.array([G.nodes[n]['x'] for n in node_ids]), c_lat, c_lon)
+        node_tree = cKDTree(np.column_stack([xs, ys]))
+        # 端の方では周辺の道路が欠けるので、判定半径ぶん内側だけを対象にする
+        bbox = ox.utils_geo.bbox_from_point((c_lat, c_lon), CITY_GRAPH_DIST - 200)
+        cities.append((bbox, (c_lat, c_lon), G, node_tree, node_ids))
+    return cities
+
+def get_city_roads(lat, lon, dist):
+    """
+    事前取得済みの都市内なら、半径dist(m)付近の道路を (道路種別, ノードID列, 座標列) のリストで返す（範囲外ならNone）
+    """
+    for (west, south, east, north), (c_lat, c_lon), G_city, city_tree, city_ids in load_city_graphs():
+        if west <= lon <= east and south <= lat <= north:
+            # graph_from_point(dist)のbbox相当(対角 dist×√2)まで含める
+            center = to_local_xy(lat, lon, c_lat, c_lon)
+            nodes = {city_ids[i] for i in city_tree.query_ball_point(center, dist * 1.5)}
+            # 範囲外に伸びる区間も残す (Overpassがway全体を返すのと同じく、端のノードの接続数を欠かさない)
+            edges = {(u, v, k): d for u, v, k, d in G_city.out_edges(nodes, keys=True, data=True)}
+            edges.update({(u, v, k): d for u, v, k, d in G_city.in_edges(nodes, keys=True, data=True)})
+            roads = []
+            for (u, v, _), d in edges.items():
+                coords = [(G_city.nodes[n]['y'], G_city.nodes[n]['x']) for n in (u, v)]
+                roads.append((d.get('highway', 'unknown'), [u, v], coords))
+            return roads
+    return None
+
 # -------------------------------------------
 # 4. 分析ロジック (AI判定エンジン)
 # -------------------------------------------
-@st.cache_data
-def assess_visibility_rank_v2(lat, lon):
-    ox.settings.log_console = False
-    
+def check_station(lat, lon, stations):
     # --------------------------------
     # A. 駅ランク評価 (最大5点)
     # --------------------------------
     station_score = 1  # デフォルト（駅なし/遠い）
     station_details = "・ 駅遠/ランク外 (1点)"
     
-    tags_station = {'railway': ['station', 'subway_entrance'], 'public_transport': 'station'}
-    try:
-        # 半径800mまで探索（徒歩10分圏内）
-        stations = ox.features.features_from_point((lat, lon), tags_station, dist=800)
+    if stations:
+        # 各駅について距離とランクを計算し、最高のスコアを採用する
+        best_s_score = 1
+        best_s_detail = "・ 駅遠/ランク外 (1点)"
+        
+        # 距離計算 (m): 全駅ぶんをまとめて計算する
+        names, st_lats, st_lons = zip(*stations)
+        xs, ys = to_local_xy(np.array(st_lats), np.array(st_lons), lat, lon)
+        dists = np.hypot(xs, ys)
         
-        if not stations.empty:
-            # 各駅について距離とランクを計算し、最高のスコアを採用する
-            best_s_score = 1
-            best_s_detail = "・ 駅遠/ランク外 (1点)"
+        for st_name, dist in zip(names, dists):
+            name = st_name or '不明な駅'
+            
+            # ランク特定
+            rank = get_station_rank_from_name(str(name))
+            
+            # スコア判定ロジック
+            # ------------------------------------------
+            # 5点：P0-1の駅徒歩3分(240m)
+            # 4点：P0-1の駅徒歩5分(400m)、P2駅徒歩3分(240m)
+            # 3点：P0-1の駅6分以上(401m~)、P2駅徒歩5分(400m)
+            # 2点：P2の駅6分以上(401m~)、P3以下駅徒歩3分(240m)
+            # 1点：P3以下徒歩4分以上（それ以外）
+            # ------------------------------------------
             
-            # geometryの代表点を作成して距離計算
-            stations['centroid'] = stations.geometry.centroid
+            current_score = 1
             
-            for idx, row in stations.iterrows():
-                # 距離計算 (m)
-                dist = geodesic((lat, lon), (row['centroid'].y, row['centroid'].x)).meters
-                name = row.get('name', '不明な駅')
-                if pd.isna(name): name = '不明な駅'
-                
-                # ランク特定
-                rank = get_station_rank_from_name(str(name))
-                
-                # スコア判定ロジック
-                # ------------------------------------------
-                # 5点：P0-1の駅徒歩3分(240m)
-                # 4点：P0-1の駅徒歩5分(400m)、P2駅徒歩3分(240m)
-                # 3点：P0-1の駅6分以上(401m~)、P2駅徒歩5分(400m)
-                # 2点：P2の駅6分以上(401m~)、P3以下駅徒歩3分(240m)
-                # 1点：P3以下徒歩4分以上（それ以外）
-                # ------------------------------------------
-                
-                current_score = 1
-                
-                if rank in ['P0', 'P1']:
-                    if dist <= 240:
-                        current_score = 5
-                    elif dist <= 400:
-                        current_score = 4
-                    else: # 6分以上 (ここでは800mまでを対象)
-                        current_score = 3
-                
-                elif rank == 'P2':
-                    if dist <= 240:
-                        current_score = 4
-                    elif dist <= 400:
-                        current_score = 3
-                    else: # 6分以上
-                        current_score = 2
-                
-                else: # P3以下 or その他
-                    if dist <= 240:
-                        current_score = 2
-                    else:
-                        current_score = 1
-
-                # 最高スコア更新
-                if current_score > best_s_score:
-                    best_s_score = current_score
-                    time_min = int(dist / 80) + 1
-                    best_s_detail = f"✅ 駅ランク: **{name}** ({rank}) 徒歩{time_min}分 ({int(dist)}m) -> {best_s_score}点"
-                
-                # 5点が出たら即終了で良い
-                if best_s_score == 5:
-                    break
+            if rank in ['P0', 'P1']:
+                if dist <= 240:
+                    current_score = 5
+                elif dist <= 400:
+                    current_score = 4
+                else: # 6分以上 (ここでは800mまでを対象)
+                    current_score = 3
             
-            station_score = best_s_score
-            station_details = best_s_detail
+            elif rank == 'P2':
+                if dist <= 240:
+                    current_score = 4
+                elif dist <= 400:
+                    current_score = 3
+                else: # 6分以上
+                    current_score = 2
             
-    except Exception as e:
-        station_details = f"駅判定エラー: {e}"
+            else: # P3以下 or その他
+                if dist <= 240:
+                    current_score = 2
+                else:
+                    current_score = 1
+
+            # 最高スコア更新
+            if current_score > best_s_score:
+                best_s_score = current_score
+                time_min = int(dist / 80) + 1
+                best_s_detail = f"✅ 駅ランク: **{name}** ({rank}) 徒歩{time_min}分 ({int(dist)}m) -> {best_s_score}点"
+            
+            # 5点が出たら即終了で良い
+            if best_s_score == 5:
+                break
+        
+        station_score = best_s_score
+        station_details = best_s_detail
+
+    return station_score, station_details
 
+def check_road(lat, lon, roads):
     # --------------------------------
     # B. ユーザー利便性 (最大5点)
     # --------------------------------
@@ -184,67 +599,31 @@ def assess_visibility_rank_v2(lat, lon):
     usability_details = []
     
     try:
-        # 道路データ取得
-        G_all = ox.graph_from_point((lat, lon), dist=100, network_type='all')
-        u, v, key = ox.distance.nearest_edges(G_all, lon, lat)
-        edge_data = G_all.get_edge_data(u, v)[key]
-        highway = edge_data.get('highway', 'unknown')
-        if isinstance(highway, list): highway = highway[0]
+        # 道路を隣り合うノード間の区間に分け、判定地点からの距離をまとめて計算しておく
+        segments = split_into_segments(roads, lat, lon)
 
-        # 交差点データ取得
-        is_intersection = False
-        try:
-            G_drive = ox.graph_from_point((lat, lon), dist=50, network_type='drive', simplify=True)
-            u_node = ox.distance.nearest_nodes(G_drive, lon, lat)
-            if G_drive.degree[u_node] >= 3:
-                is_intersection = True
-        except: pass
-
-        # 道路種別定義
-        major_roads = ['motorway', 'trunk', 'primary', 'secondary'] # 5点
-        medium_roads = ['tertiary'] # 4点
-        commercial_roads = ['pedestrian', 'living_street'] # 3点 (商店街扱い)
-        living_roads = ['residential', 'unclassified'] # 1点
-        non_vehicle = ['footway', 'path', 'steps', 'cycleway']
+        # 半径100m以内で最も近い道路の種別
+        highway = nearest_highway(segments, ROAD_SEARCH_DIST)
+        if highway is None:
+            raise ValueError(f"半径{ROAD_SEARCH_DIST}m以内に道路が見つかりません")
+
+        # 交差点データ取得 (半径50m以内)
+        is_intersection = has_intersection(segments, INTERSECTION_SEARCH_DIST)
 
         # 歩道救済: 歩道上にいる場合、近くの車道をチェック
         final_highway = highway
-        if highway in non_vehicle:
-            try:
-                G_drive_near = ox.graph_from_point((lat, lon), dist=50, network_type='drive')
-                u_d, v_d, key_d = ox.distance.nearest_edges(G_drive_near, lon, lat)
-                h_drive = G_drive_near.get_edge_data(u_d, v_d)[key_d].get('highway', 'unknown')
-                if isinstance(h_drive, list): h_drive = h_drive[0]
-                
-                # 幹線・一般道ならそちらの評価を採用
-                if h_drive in major_roads or h_drive in medium_roads:
-                    final_highway = h_drive
-                    usability_details.append(f"ℹ️ (歩道上ですが横に{final_highway}を検知)")
-            except: pass
+        if highway in NON_VEHICLE_HIGHWAYS:
+            h_drive = nearest_highway(segments, INTERSECTION_SEARCH_DIST, DRIVABLE_HIGHWAYS)
+            
+            # 幹線・一般道(4点以上)ならそちらの評価を採用
+            if h_drive is not None and HIGHWAY_CATEGORY.get(h_drive, DEFAULT_HIGHWAY_CATEGORY)[0] >= 4:
+                final_highway = h_drive
+                usability_details.append(f"ℹ️ (歩道上ですが横に{final_highway}を検知)")
 
         # スコア算出 (条件に合致する最も高いものを採用)
-        temp_score = 0
-        road_reason = ""
-
         # 1. 道路種別によるベーススコア
-        if final_highway in major_roads:
-            temp_score = 5
-            road_reason = f"幹線道路({final_highway})"
-        elif final_highway in medium_roads:
-            temp_score = 4
-            road_reason = f"バス通り({final_highway})"
-        elif final_highway in commercial_roads:
-            temp_score = 3
-            road_reason = f"商店街/歩行者優先({final_highway})"
-        elif final_highway in living_roads:
-            temp_score = 1
-            road_reason = f"住宅街({final_highway})"
-        elif highway in ['service']:
-            temp_score = 0
-            road_reason = "敷地内/私道"
-        else:
-            temp_score = 0
-            road_reason = f"その他({highway})"
+        temp_score, reason_template = HIGHWAY_CATEGORY.get(final_highway, DEFAULT_HIGHWAY_CATEGORY)
+        road_reason = reason_template.format(final_highway)
 
         # 2. 交差点判定 (最低2点保証)
         if is_intersection:
@@ -257,9 +636,26 @@ def assess_visibility_rank_v2(lat, lon):
         usability_score = temp_score
         usability_details.append(f"✅ 利便性: {road_reason} -> {usability_score}点")
 
-    except Exception as e:
+    except ValueError as e:
         usability_details.append(f"道路データエラー: {e}")
 
+    return usability_score, usability_details
+
+@st.cache_data(max_entries=RESULT_MEMORY_ENTRIES)
+@quantized_cache
+def assess_visibility_rank_v2(lat, lon):
+    # 駅・道路データはまとめて1回で取得し、A・Bの判定はメモリ上で行う
+    fetch_error = None
+    try:
+        stations, roads = get_neighborhood(lat, lon)
+    except (httpx.HTTPError, ValueError) as e:
+        fetch_error = e
+        station_score, station_details = 1, f"駅判定エラー: {e}"
+        usability_score, usability_details = 0, [f"道路データエラー: {e}"]
+    else:
+        station_score, station_details = check_station(lat, lon, stations)
+        usability_score, usability_details = check_road(lat, lon, roads)
+
     # --------------------------------
     # C. 合計とランク
     # --------------------------------
@@ -282,31 +678,37 @@ def assess_visibility_rank_v2(lat, lon):
     all_details = [station_details] + usability_details
     detail_str = " / ".join(all_details)
     
+    if fetch_error is not None:
+        raise NeighborhoodFetchError((rank, total_score, detail_str, color), fetch_error)
     return rank, total_score, detail_str, color
 
+def assess_visibility(lat, lon):
+    """
+    判定結果を返す。周辺データの取得に失敗した場合も暫定結果を返す (キャッシュはされない)
+    """
+    try:
+        return assess_visibility_rank_v2(lat, lon)
+    except NeighborhoodFetchError as e:
+        return e.result
+
 # -------------------------------------------
 # 5. ヘルパー関数: 並列実行用
 # -------------------------------------------
-def process_single_row(row_data):
-    index, row, target_col = row_data
-    raw_input = str(row[target_col])
-    coords = extract_coords_from_input(raw_input)
-
-    result = {
+def new_result(index, coords=None):
+    lat, lon = coords or (None, None)
+    return {
         "index": index, "AIランク": "エラー", "AIスコア": 0,
-        "AI判定理由": "座標取得失敗", "緯度": None, "経度": None
+        "AI判定理由": "座標取得失敗", "緯度": lat, "経度": lon
     }
-    if coords:
-        lat, lon = coords
-        try:
-            rank, score, detail, _ = assess_visibility_rank_v2(lat, lon)
-            result["AIランク"] = rank
-            result["AIスコア"] = score
-            result["AI判定理由"] = detail
-            result["緯度"] = lat
-            result["経度"] = lon
-        except: result["AI判定理由"] = "分析エラー"
-    return result
+
+def process_single_row(index, raw_input):
+    return new_result(index, extract_coords_from_input(raw_input))
+
+def assess_cell(lat, lon):
+    try:
+        rank, score, detail, _ = assess_visibility(lat, lon)
+        return {"AIランク": rank, "AIスコア": score, "AI判定理由": detail}
+    except Exception: return {"AIランク": "エラー", "AIスコア": 0, "AI判定理由": "分析エラー"}
 
 # -------------------------------------------
 # 6. UI部分
@@ -329,7 +731,7 @@ with tab1:
                 df_map = pd.DataFrame({'lat': [lat], 'lon': [lon]})
                 st.map(df_map, zoom=15)
                 with st.spinner('AI分析中...'):
-                    rank, score, detail_str, color = assess_visibility_rank_v2(lat, lon)
+                    rank, score, detail_str, color = assess_visibility(lat, lon)
                 st.divider()
                 col1, col2 = st.columns(2)
                 with col1: st.markdown(f"総合ランク: :{color}[**{rank}**]")
@@ -340,36 +742,72 @@ with tab1:
 with tab2:
     st.markdown("""
     **CSVファイルをアップロードしてください。** (推奨: URLまたは座標列)
-    ※ 最大5並列で高速処理します。最大２０件まででお願いします。
+    ※ 最大10並列で高速処理します。最大２０件まででお願いします。
     そうそう、しっかり休憩も挟んで、メリハリ付けてね。
     """)
     uploaded_file = st.file_uploader("CSVファイルをドラッグ&ドロップ", type="csv")
     if uploaded_file:
-        df = pd.read_csv(uploaded_file)
+        df = pd.read_csv(uploaded_file, engine="pyarrow", dtype_backend="pyarrow")
         st.dataframe(df.head(3))
         target_col = st.selectbox("📍 座標またはURLが入っている列", df.columns)
         if st.button("一括判定を実行 (高速モード)", type="primary"):
             st.info("分析を開始します...")
-            results = {}
             total = len(df)
             progress_bar = st.progress(0)
             status_text = st.empty()
-            with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-                tasks = [executor.submit(process_single_row, (i, row, target_col)) for i, row in df.iterrows()]
-                for i, future in enumerate(concurrent.futures.as_completed(tasks)):
-                    res = future.result()
-                    results[res["index"]] = res
-                    progress_bar.progress((i + 1) / total)
-                    status_text.text(f"分析中... {i+1} / {total} 件完了")
+            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+                # 1) 先に全行の座標を取り出す
+                #    「緯度,経度」だけの行は列ごとまとめて解析し、URL・住所の行だけを並列で1件ずつ処理する
+                status_text.text("座標を取得中...")
+                raw_inputs = df[target_col].astype(str)
+                extracted = raw_inputs.str.extract(_RE_COORD_PAIR).astype(float)
+                # 範囲外の値はここでは採用せず、1件ずつの処理で座標取得失敗にする
+                is_coord = (extracted[0].between(-90, 90) & extracted[1].between(-180, 180)).to_numpy()
+                lats, lons = extracted[0].to_numpy(), extracted[1].to_numpy()
+                results_list = [new_result(i, (lats[i], lons[i])) if is_coord[i] else None for i in range(total)]
+                pending = np.flatnonzero(~is_coord)
+                raw_values = raw_inputs.to_numpy()
+                futures = [executor.submit(process_single_row, i, raw_values[i]) for i in pending]
+                # 進捗は「座標取得(URL・住所の行) + 判定(全行)」を合わせた件数で表示する
+                # 画面更新は通信を伴うので、どちらの段階も表示は最大100回程度に間引く
+                work = len(pending) + total
+                step = max(1, len(futures) // 100)
+                for n, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                    if future.exception() is None:
+                        res = future.result()
+                        results_list[res["index"]] = res
+                    if n % step == 0 or n == len(futures):
+                        progress_bar.progress(n / work)
+                        status_text.text(f"座標を取得中... {n} / {len(futures)} 件完了")
+                # 想定外のエラーで落ちた行は座標取得失敗として扱う
+                results_list = [res if res is not None else new_result(j) for j, res in enumerate(results_list)]
+
+                # 2) 同じH3セルに入る行はまとめ、セルごとに1回だけ判定して結果を配る
+                buckets = {}
+                for res in results_list:
+                    if res["緯度"] is None: continue
+                    buckets.setdefault(h3.latlng_to_cell(res["緯度"], res["経度"], H3_RESOLUTION), []).append(res)
+                done = total - sum(len(members) for members in buckets.values())
+                tasks = {executor.submit(assess_cell, members[0]["緯度"], members[0]["経度"]): members for members in buckets.values()}
+                step = max(1, len(tasks) // 100)
+                for n, future in enumerate(concurrent.futures.as_completed(tasks), 1):
+                    verdict = future.result()
+                    for res in tasks[future]: res.update(verdict)
+                    done += len(tasks[future])
+                    if n % step == 0 or n == len(tasks):
+                        progress_bar.progress((len(pending) + done) / work)
+                        status_text.text(f"分析中... {done} / {total} 件完了")
+            # 座標が1件も取れなかった場合なども含め、最後は必ず100%にする
+            progress_bar.progress(1.0)
+            status_text.text(f"分析中... {total} / {total} 件完了")
             
-            results_list = [results[i] for i in range(total)]
-            df["AIランク"] = [r["AIランク"] for r in results_list]
-            df["AIスコア"] = [r["AIスコア"] for r in results_list]
-            df["AI判定理由"] = [r["AI判定理由"] for r in results_list]
-            df["緯度"] = [r["緯度"] for r in results_list]
-            df["経度"] = [r["経度"] for r in results_list]
+            result_df = pd.DataFrame(results_list, columns=["AIランク", "AIスコア", "AI判定理由", "緯度", "経度"])
+            # 判定済みCSVを再投入した場合は古い結果列を置き換える
+            df = pd.concat([df.drop(columns=result_df.columns, errors="ignore").reset_index(drop=True), result_df], axis=1)
             
             st.success(f"✅ 分析完了！")
             st.dataframe(df)
-            csv = df.to_csv(index=False).encode('utf-8-sig')
-            st.download_button("結果CSVをダウンロード", data=csv, file_name="scooter_ai_results_v2.csv", mime="text/csv")
+            # Excelで文字化けしないようBOM付きUTF-8で直接バイト列に書き出す
+            csv = io.BytesIO()
+            df.to_csv(csv, index=False, encoding='utf-8-sig')
+            st.download_button("結果CSVをダウンロード", data=csv.getvalue(), file_name="scooter_ai_results_v2.csv", mime="text/csv")